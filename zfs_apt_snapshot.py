@@ -13,18 +13,29 @@ Python 3.5.
 """
 
 import argparse
+import bz2
 import ctypes
+import ctypes.util
 import collections
 import datetime
 import enum
+import fcntl
 import functools
+import gzip
+import hashlib
+import io
+import json
 import locale
 import logging
+import lzma
 import operator
 import os
 import pathlib
+import re
 import subprocess
 import sys
+import tarfile
+import time
 
 import apt
 from apt.debfile import DebPackage
@@ -37,6 +48,8 @@ except ImportError:
     _lzc_snap = None
     _lzc_list_snaps = None
     _lzc_get_props = None
+    _lzc_destroy_snaps = None
+    _lzc_rollback_to = None
 else:
     _lzc_snapshot = getattr(zfs, "lzc_snapshot", None)
     if not zfs.is_supported(_lzc_snapshot):
@@ -50,9 +63,18 @@ else:
     _lzc_get_props = getattr(zfs, "lzc_get_props", None)
     if not zfs.is_supported(_lzc_get_props):
         _lzc_get_props = None
-    _lzc_destroy_snaps = getattr(zfs, "lzc_get_props", None)
+    _lzc_destroy_snaps = getattr(zfs, "lzc_destroy_snaps", None)
     if not zfs.is_supported(_lzc_destroy_snaps):
         _lzc_destroy_snaps = None
+    _lzc_rollback_to = getattr(zfs, "lzc_rollback_to", None)
+    if not zfs.is_supported(_lzc_rollback_to):
+        _lzc_rollback_to = None
+# zstd compressed .deb packages (used by Ubuntu since 21.10) need an external
+# module to decompress.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # Get the current default locale early on
@@ -78,14 +100,14 @@ class APTSnapshotError(Exception):
     def __init__(self, *args, subprocess_return=None, **kwargs):
         if subprocess_return is not None:
             self.subprocess_return = subprocess_return
-            args = b" ".join(self.subprocess_return.args)
+            command = b" ".join(self.subprocess_return.args)
             if self.subprocess_return.stderr:
                 error_output = self.subprocess_return.stderr
             else:
                 error_output = self.subprocess_return.stdout
             message = "Error running command `{}`: {}".format(
-                args.decode(default_encoding),
-                error_output
+                command.decode(default_encoding),
+                error_output.decode(default_encoding).strip()
             )
             super().__init__(message, *args, **kwargs)
         else:
@@ -104,9 +126,23 @@ class ZFSListError(APTSnapshotError): pass
 class ZFSGetPropertiesError(APTSnapshotError): pass
 
 
+class ZFSRollbackError(APTSnapshotError): pass
+
+
+class SnapshotDestructionError(APTSnapshotError): pass
+
+
 SNAPSHOT_PREFIX = "zfs-apt-snap"
 SNAPSHOT_PREFIX_BYTES = SNAPSHOT_PREFIX.encode(default_encoding)
 SNAPSHOT_TIMESTAMP_FORMAT = "%Y-%m-%dT%H%M%S"
+STATE_DIRECTORY = pathlib.Path("/var/lib/zfs-apt-snapshot")
+PURGE_DUE_FILENAME = "purge-due"
+PURGE_LOCK_FILENAME = "purge.lock"
+RECENT_SNAPSHOTS_FILENAME = "recent-snapshots"
+MOUNT_CACHE_FILENAME = "mounts.json"
+MOUNTINFO_PATH = pathlib.Path("/proc/self/mountinfo")
+# Niceness increment applied to the deferred purge job
+PURGE_NICENESS = 10
 
 
 def ensure_bytes(func):
@@ -133,22 +169,32 @@ for lzc_func in (_lzc_snapshot, _lzc_snap):
                 lzc_func([name])
             except zfs.exceptions.SnapshotExists as e:
                 raise SnapshotExists() from e
+            except zfs.exceptions.SnapshotFailure as e:
+                # Failures for individual snapshots are wrapped up in
+                # SnapshotFailure.errors
+                if e.errors and all(
+                    isinstance(error, zfs.exceptions.SnapshotExists)
+                    for error in e.errors
+                ):
+                    raise SnapshotExists() from e
+                raise SnapshotCreationError() from e
         break
 else:
     @ensure_bytes
     def create_snapshot(name):
-        if isinstance(name, str):
-            args = [b"zfs", b"snapshot", name],
-            log_external(args)
-            ret = subprocess.run(
-                args,
-                check=False,
-                stderr=subprocess.STDOUT,
-                stdout=subprocess.PIPE
-            )
-            if ret.returncode != 0:
-                # TODO do further checking about what kind of error this is
-                raise SnapshotCreationError(subprocess_return=ret)
+        args = [b"zfs", b"snapshot", name]
+        log_external(args)
+        ret = subprocess.run(
+            args,
+            check=False,
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE
+        )
+        if ret.returncode != 0:
+            if b"dataset already exists" in ret.stdout:
+                raise SnapshotExists(subprocess_return=ret)
+            # TODO do further checking about what kind of error this is
+            raise SnapshotCreationError(subprocess_return=ret)
 
 
 if _lzc_list_snaps is not None:
@@ -215,6 +261,18 @@ else:
             return properties
 
 
+def group_by_pool(names):
+    """Group dataset or snapshot names by the pool they're in.
+
+    :rtype: collections.OrderedDict[bytes: List[bytes]]
+    """
+    pools = collections.OrderedDict()
+    for name in names:
+        pool = name.split(b"@", 1)[0].split(b"/", 1)[0]
+        pools.setdefault(pool, []).append(name)
+    return pools
+
+
 if _lzc_destroy_snaps is not None:
     @ensure_bytes
     def destroy_snapshots(*names):
@@ -222,7 +280,17 @@ if _lzc_destroy_snaps is not None:
             "Destroying snapshots:\n\t%s",
             "\n\t".join(n.decode(default_encoding) for n in names)
         )
-        _lzc_destroy_snaps(names)
+        # lzc_destroy_snaps() requires all snapshots to be in the same pool
+        for pool, pool_names in group_by_pool(names).items():
+            try:
+                _lzc_destroy_snaps(pool_names, defer=False)
+            except zfs.exceptions.ZFSError as e:
+                raise SnapshotDestructionError(
+                    "Unable to destroy snapshots in pool '{}': {}".format(
+                        pool.decode(default_encoding),
+                        e
+                    )
+                ) from e
 else:
     @ensure_bytes
     def destroy_snapshots(*names):
@@ -230,16 +298,53 @@ else:
             "Destroying snapshots:\n\t%s",
             "\n\t".join(n.decode(default_encoding) for n in names)
         )
-        base_args = [b"zfs", b"destroy"]
+        # `zfs destroy` can take multiple snapshots of the same dataset in one
+        # invocation, as `dataset@snap1,snap2,...`
+        dataset_snapshots = collections.OrderedDict()
         for name in names:
-            args = base_args + [name]
+            dataset, snapshot = name.split(b"@", 1)
+            dataset_snapshots.setdefault(dataset, []).append(snapshot)
+        base_args = [b"zfs", b"destroy"]
+        for dataset, snapshots in dataset_snapshots.items():
+            args = base_args + [dataset + b"@" + b",".join(snapshots)]
             log_external(args)
             ret = subprocess.run(
                 args,
-                check=True,
+                check=False,
                 stderr=subprocess.STDOUT,
                 stdout=subprocess.PIPE
             )
+            if ret.returncode != 0:
+                raise SnapshotDestructionError(subprocess_return=ret)
+
+
+if _lzc_rollback_to is not None:
+    @ensure_bytes
+    def rollback_snapshot(name):
+        dataset = name.split(b"@", 1)[0]
+        try:
+            _lzc_rollback_to(dataset, name)
+        except zfs.exceptions.ZFSError as e:
+            raise ZFSRollbackError(
+                "Unable to roll back '{}' to '{}': {}".format(
+                    dataset.decode(default_encoding),
+                    name.decode(default_encoding),
+                    e
+                )
+            ) from e
+else:
+    @ensure_bytes
+    def rollback_snapshot(name):
+        args = [b"zfs", b"rollback", name]
+        log_external(args)
+        ret = subprocess.run(
+            args,
+            check=False,
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE
+        )
+        if ret.returncode != 0:
+            raise ZFSRollbackError(subprocess_return=ret)
 
 
 @ensure_bytes
@@ -274,7 +379,7 @@ def _zfs_list(*names, type_=None, fields=(b"name",)):
         raise ZFSListError(subprocess_return=ret)
     else:
         # strip() the output to trim trailing newlines
-        rows = ret.stdout.strip().split(b"\n")
+        rows = [row for row in ret.stdout.strip().split(b"\n") if row]
         if len(fields) == 1:
             # If we only have one field, just return the list of strings
             return rows
@@ -310,6 +415,21 @@ MountEntryPointer = ctypes.POINTER(MountEntry)
 Filesystem = collections.namedtuple("Filesystem", ["type_", "name"])
 
 
+MountInfo = collections.namedtuple(
+    "MountInfo",
+    [
+        "mount_id",
+        "parent_id",
+        "major",
+        "minor",
+        "root",
+        "mountpoint",
+        "type_",
+        "source",
+    ]
+)
+
+
 _libc = None
 
 
@@ -335,11 +455,107 @@ def get_libc():
     return _libc
 
 
-def list_mounted_filesystems():
+_MOUNTINFO_ESCAPE = re.compile(rb"\\([0-7]{3})")
+
+
+def _unescape_mountinfo(field):
+    """Decode a mountinfo path field, undoing the kernel's octal escapes."""
+    field = _MOUNTINFO_ESCAPE.sub(
+        lambda match: bytes([int(match.group(1), 8)]),
+        field
+    )
+    return field.decode(default_encoding, "surrogateescape")
+
+
+def parse_mountinfo(data):
+    """Parse the contents of a ``/proc/<pid>/mountinfo`` file.
+
+    See proc(5) for details on the format.
+
+    :rtype: List[MountInfo]
+    """
+    mounts = []
+    for line in data.split(b"\n"):
+        if line == b"":
+            continue
+        fields = line.split(b" ")
+        # There are a variable number of optional fields, terminated by a
+        # single hyphen.
+        separator = fields.index(b"-", 6)
+        major, minor = fields[2].split(b":")
+        mounts.append(MountInfo(
+            int(fields[0]),
+            int(fields[1]),
+            int(major),
+            int(minor),
+            _unescape_mountinfo(fields[3]),
+            _unescape_mountinfo(fields[4]),
+            fields[separator + 1].decode(default_encoding),
+            _unescape_mountinfo(fields[separator + 2]),
+        ))
+    return mounts
+
+
+def load_mountinfo(state_dir=None):
+    """Return the current mount table from ``/proc/self/mountinfo``.
+
+    If ``state_dir`` is given, the parsed table is cached there along with a
+    hash of the mountinfo contents, and reused as long as the mount table
+    hasn't changed.
+
+    :rtype: List[MountInfo]
+    """
+    with MOUNTINFO_PATH.open("rb") as mountinfo_file:
+        data = mountinfo_file.read()
+    if state_dir is None:
+        return parse_mountinfo(data)
+    digest = hashlib.sha1(data).hexdigest()
+    cache_file = state_dir / MOUNT_CACHE_FILENAME
+    try:
+        with cache_file.open("r") as f:
+            cache = json.load(f)
+        if cache["hash"] == digest:
+            log.debug("Using cached mount table from '%s'", cache_file)
+            return [MountInfo(*mount) for mount in cache["mounts"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        # Missing or corrupt caches are just regenerated
+        pass
+    mounts = parse_mountinfo(data)
+    try:
+        state_dir.mkdir(parents=True, exist_ok=True)
+        temp_file = cache_file.with_name(cache_file.name + ".tmp")
+        with temp_file.open("w") as f:
+            json.dump({"hash": digest, "mounts": mounts}, f)
+        os.replace(str(temp_file), str(cache_file))
+    except OSError as e:
+        log.debug("Unable to cache mount table: %s", e)
+    return mounts
+
+
+def list_mounted_filesystems(state_dir=None):
     """Return information on all currently mounted filesystems.
 
+    The mount table is read from ``/proc/self/mountinfo`` with
+    :py:func:`load_mountinfo`. If ``state_dir`` is given, the parsed table is
+    cached there and reused until the mount table changes. ``/etc/mtab`` is
+    only read (with ``getmntent(3)``) as a fallback when ``/proc`` isn't
+    mounted, and isn't cached.
+
+    :param state_dir: The directory to cache the mount table in, or ``None``
+        to not cache it.
+    :type state_dir: pathlib.Path or None
     :rtype: Dict[pathlib.Path: Filesystem]
     """
+    if MOUNTINFO_PATH.exists():
+        # Later mounts on the same mount point hide earlier ones, so let them
+        # replace the earlier entries.
+        return {
+            pathlib.Path(mount.mountpoint): Filesystem(
+                mount.type_,
+                mount.source
+            )
+            for mount in load_mountinfo(state_dir)
+        }
     libc = get_libc()
     mtab_handle = libc.setmntent(b"/etc/mtab", b"r")
     filesystems = {}
@@ -383,9 +599,9 @@ def list_zfs_volumes():
     return volumes
 
 
-def get_filesystems(*paths):
+def get_filesystems(*paths, state_dir=None):
     """Return the names of the ZFS filesystems the given paths exist on."""
-    mounted_filesystems = list_mounted_filesystems()
+    mounted_filesystems = list_mounted_filesystems(state_dir)
     zfs_volumes = list_zfs_volumes()
     affected_datasets = set()
     for path in paths:
@@ -443,22 +659,177 @@ def list_apt_snapshots():
     return apt_snapshots
 
 
+class DebFormatError(APTSnapshotError): pass
+
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+
+
+class _ArMemberReader(io.RawIOBase):
+    """Read-only file object limited to the payload of a single ar member.
+
+    Seeking is supported (relative to the start of the member) so that
+    uncompressed tar archives can skip over file contents without reading
+    them.
+    """
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._start = fileobj.tell()
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._fileobj.seekable()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        self._position = max(0, min(position, self._size))
+        self._fileobj.seek(self._start + self._position)
+        return self._position
+
+    def readinto(self, buffer):
+        remaining = self._size - self._position
+        if remaining <= 0:
+            return 0
+        view = memoryview(buffer)[:remaining]
+        count = self._fileobj.readinto(view)
+        self._position += count
+        return count
+
+
+def _iter_ar_members(fileobj):
+    """Yield ``(name, size)`` for each member of an ar archive.
+
+    The file object is left positioned at the start of each member's payload
+    when it is yielded. Payloads the caller doesn't read are skipped by
+    seeking.
+    """
+    if fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebFormatError("Not an ar archive.")
+    offset = len(AR_MAGIC)
+    while True:
+        fileobj.seek(offset)
+        header = fileobj.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+        if header[58:60] != b"`\n":
+            raise DebFormatError("Corrupt ar member header.")
+        # GNU ar terminates names with a slash, BSD ar pads with spaces.
+        name = header[0:16].rstrip(b" ").rstrip(b"/").decode("ascii")
+        size = int(header[48:58].strip())
+        yield name, size
+        # Member payloads are padded to an even length
+        offset += AR_HEADER_SIZE + size + (size % 2)
+
+
+def _open_data_tar(name, member):
+    """Open the data member of a .deb for streaming by its compression type.
+
+    Returns ``None`` if the compression format is not supported.
+    """
+    if name == "data.tar":
+        # Uncompressed tar archives can seek past file contents entirely.
+        return tarfile.open(fileobj=member, mode="r:")
+    elif name == "data.tar.gz":
+        decompressed = gzip.GzipFile(fileobj=member, mode="rb")
+    elif name == "data.tar.xz":
+        decompressed = lzma.LZMAFile(member)
+    elif name == "data.tar.bz2":
+        decompressed = bz2.BZ2File(member)
+    elif name == "data.tar.zst" and zstandard is not None:
+        decompressed = zstandard.ZstdDecompressor().stream_reader(member)
+    else:
+        return None
+    # Stream mode only ever reads forward, decompressing in small blocks.
+    return tarfile.open(fileobj=decompressed, mode="r|")
+
+
+def iter_deb_paths(filename):
+    """Yield the path names in the data archive of a .deb package.
+
+    Only the ar and tar headers are examined; member payloads are skipped
+    (seeked over when uncompressed, streamed through the decompressor
+    otherwise), so memory use doesn't depend on the size of the package. If
+    the data archive uses a compression format that can't be streamed, this
+    falls back to :py:attr:`apt.debfile.DebPackage.filelist`.
+    """
+    with open(filename, "rb") as deb_file:
+        for name, size in _iter_ar_members(deb_file):
+            if not name.startswith("data.tar"):
+                continue
+            member = _ArMemberReader(deb_file, size)
+            tar = _open_data_tar(name, member)
+            if tar is None:
+                log.debug(
+                    "Unable to stream '%s' from '%s', falling back to APT.",
+                    name,
+                    filename
+                )
+                break
+            with tar:
+                tarinfo = tar.next()
+                while tarinfo is not None:
+                    yield tarinfo.name
+                    # TarFile keeps a list of every member it's seen; empty it
+                    # so memory use stays flat.
+                    tar.members = []
+                    tarinfo = tar.next()
+            return
+        else:
+            raise DebFormatError(
+                "No data archive found in '{}'.".format(filename)
+            )
+    yield from DebPackage(filename=filename).filelist
+
+
+class DebArchive:
+    """A .deb package file whose contents are listed by streaming.
+
+    This provides the subset of the :py:class:`apt.debfile.DebPackage`
+    interface used by :py:func:`directories_for_package`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @property
+    def pkgname(self):
+        # Package files are named ``<name>_<version>_<arch>.deb``
+        return pathlib.Path(self.filename).name.split("_", 1)[0]
+
+    @property
+    def filelist(self):
+        return iter_deb_paths(self.filename)
+
+
 def directories_for_package(pkg):
     """Return a list of the directories a package is modifying."""
     directories = set()
     if hasattr(pkg, "filelist"):
-        # apt.debfile.DebPackage
+        # DebArchive or apt.debfile.DebPackage
         log.info("Getting paths from .deb package '%s'.", pkg.pkgname)
         path_strs = pkg.filelist
     elif hasattr(pkg, "installed_files"):
         # apt.Package
         log.info("Getting paths from cached APT package '%s'.", pkg.name)
         path_strs = pkg.installed_files
-    # Figure out the root path to add to relative paths
-    log.debug("Paths for %s: %s", pkg, path_strs)
-    first_path = path_strs[0]
-    if first_path in {"./", "/.", "/"}:
-        path_prefix = pathlib.PurePosixPath("/")
+    # Relative paths (from .deb archives) are relative to the root directory.
+    path_prefix = pathlib.PurePosixPath("/")
     paths = (
         pathlib.PurePosixPath(p)
         for p in path_strs
@@ -472,10 +843,11 @@ def directories_for_package(pkg):
             path = path_prefix / path
         directories.difference_update(path.parents)
         directories.add(path)
+    log.debug("Paths for %s: %s", pkg, directories)
     return directories
 
 
-def filesystems_for_files(files):
+def filesystems_for_files(files, state_dir=None):
     """Return a list of ZFS filesystems modified by the given packages."""
     filesystems = set()
     filtered_files = set(files)
@@ -494,7 +866,7 @@ def filesystems_for_files(files):
     # convert the path list to a queue so we can put things at the end for
     # later processing
     paths = collections.deque(filtered_files)
-    return get_filesystems(*paths)
+    return get_filesystems(*paths, state_dir=state_dir)
 
 
 def get_files(stream):
@@ -526,7 +898,7 @@ def get_files(stream):
         # handle the version 1 case first, it's simple
         while line != "":
             log.debug("Hook protocol line: '%s'", line)
-            pkg = DebPackage(filename=line)
+            pkg = DebArchive(line)
             # Keep the package objects around only as long as they're needed,
             # otherwise you'll open too many files.
             directories.update(directories_for_package(pkg))
@@ -580,7 +952,7 @@ def get_files(stream):
                     # anyways).
                     directories.update(directories_for_package(cached_package))
             else:
-                deb_package = DebPackage(filename=action)
+                deb_package = DebArchive(action)
                 directories.update(directories_for_package(deb_package))
                 if installed_version != "-":
                     # If we're upgrading from an old package, make sure to look
@@ -648,6 +1020,285 @@ def list_old(period):
     return old_snaps
 
 
+RecentSnapshot = collections.namedtuple(
+    "RecentSnapshot",
+    ["name", "timestamp"]
+)
+
+
+def load_recent_snapshots(state_dir):
+    """Return the last snapshot made by this tool for each dataset.
+
+    This is read from a state file so that finding recent snapshots doesn't
+    mean listing every snapshot of each dataset; callers should still check
+    that a recorded snapshot exists before relying on it. Missing or
+    unreadable state is treated as there being no recent snapshots.
+
+    :rtype: Dict[bytes: RecentSnapshot]
+    """
+    recent = {}
+    try:
+        with open(str(state_dir / RECENT_SNAPSHOTS_FILENAME), "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\n")
+                if line == b"":
+                    continue
+                try:
+                    snapshot, timestamp = line.rsplit(b"\t", 1)
+                    dataset, _ = snapshot.split(b"@", 1)
+                    recent[dataset] = RecentSnapshot(
+                        snapshot,
+                        datetime.datetime.strptime(
+                            timestamp.decode(default_encoding),
+                            SNAPSHOT_TIMESTAMP_FORMAT
+                        )
+                    )
+                except ValueError:
+                    log.warning("Ignoring invalid state line '%s'", line)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning("Unable to read recent snapshots: %s", e)
+    return recent
+
+
+def save_recent_snapshots(state_dir, recent):
+    """Save the mapping of datasets to the last snapshot made of them.
+
+    Failing to save is logged, but otherwise ignored; it only means the next
+    run may make snapshots it didn't need to.
+    """
+    state_file = state_dir / RECENT_SNAPSHOTS_FILENAME
+    temp_file = state_file.with_name(state_file.name + ".tmp")
+    try:
+        state_dir.mkdir(parents=True, exist_ok=True)
+        with open(str(temp_file), "wb") as f:
+            for snapshot in sorted(recent.values()):
+                f.write(b"\t".join([
+                    snapshot.name,
+                    snapshot.timestamp.strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+                    .encode(default_encoding),
+                ]) + b"\n")
+        # Replace the old file atomically so concurrent readers never see a
+        # partial file.
+        os.replace(str(temp_file), str(state_file))
+    except OSError as e:
+        log.warning("Unable to save recent snapshots: %s", e)
+
+
+def request_purge(state_dir, old_period):
+    """Record that a purge of snapshots older than ``old_period`` days is due.
+    """
+    state_dir.mkdir(parents=True, exist_ok=True)
+    purge_due = state_dir / PURGE_DUE_FILENAME
+    timestamp = datetime.datetime.utcnow().strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+    purge_due.write_text("{}\t{}\n".format(timestamp, old_period))
+    log.debug("Recorded deferred purge in '%s'", purge_due)
+
+
+def run_deferred_purge(args):
+    """Purge stale snapshots if a purge has been requested.
+
+    Snapshots are considered stale using the ``--old-period`` given when the
+    purge was requested, falling back to ``args.old_period``. A lock file guards against multiple purges running at once; if another
+    purge is already running this returns immediately. Snapshots are destroyed
+    in batches of at most ``args.deferred_batch_size`` from a single pool,
+    sleeping ``args.deferred_interval`` seconds in between.
+    """
+    state_dir = args.state_dir
+    purge_due = state_dir / PURGE_DUE_FILENAME
+    if not purge_due.exists():
+        log.debug("No deferred purge requested.")
+        return
+    state_dir.mkdir(parents=True, exist_ok=True)
+    with open(str(state_dir / PURGE_LOCK_FILENAME), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.info("Another purge is already running, skipping.")
+            return
+        # Remember which request we're handling, so that one made while we're
+        # running isn't cleared with it. The request may have been handled by
+        # another purge between checking for it and taking the lock.
+        try:
+            requested = purge_due.stat().st_mtime_ns
+        except FileNotFoundError:
+            log.debug("Deferred purge already handled.")
+            return
+        os.nice(PURGE_NICENESS)
+        old_period = args.old_period
+        try:
+            _, requested_period = purge_due.read_text().split("\t")
+            old_period = int(requested_period)
+        except ValueError:
+            log.warning(
+                "Unable to read the requested old period, using %d days.",
+                old_period
+            )
+        old_snaps = list_old(old_period)
+        batch_size = max(1, args.deferred_batch_size)
+        first_batch = True
+        for pool_snaps in group_by_pool(old_snaps).values():
+            for start in range(0, len(pool_snaps), batch_size):
+                if not first_batch:
+                    time.sleep(args.deferred_interval)
+                first_batch = False
+                destroy_snapshots(*pool_snaps[start:start + batch_size])
+        # Only clear the request once the purge has succeeded, so a failed
+        # purge is retried the next time we're run.
+        if purge_due.stat().st_mtime_ns == requested:
+            purge_due.unlink()
+        else:
+            log.debug("Purge requested while running, leaving it for later.")
+
+
+RollbackPlan = collections.namedtuple(
+    "RollbackPlan",
+    [
+        # The snapshots being rolled back to, grouped by pool
+        "pool_snapshots",
+        # Newer snapshots that have to be destroyed first, grouped by pool
+        "pool_newer",
+        # Newer snapshots that can't be destroyed as they have clones, mapped
+        # to those clones
+        "blocked",
+    ]
+)
+
+
+@ensure_bytes
+def plan_rollback(snapshot_name):
+    """Work out what's needed to roll every dataset back to a snapshot.
+
+    All snapshots are listed once, and every dataset with a snapshot named
+    ``snapshot_name`` is rolled back to it. Any snapshots of those datasets
+    created after it have to be destroyed for the rollback to succeed.
+
+    :rtype: RollbackPlan
+    """
+    snapshots = _zfs_list(
+        type_="snapshot",
+        fields=("name", "createtxg", "clones")
+    )
+    dataset_snapshots = collections.defaultdict(list)
+    for snapshot in snapshots:
+        dataset, name = snapshot.name.split(b"@", 1)
+        dataset_snapshots[dataset].append(snapshot)
+    pool_snapshots = collections.OrderedDict()
+    pool_newer = collections.OrderedDict()
+    blocked = {}
+    for dataset in sorted(dataset_snapshots):
+        target = dataset + b"@" + snapshot_name
+        targets = [s for s in dataset_snapshots[dataset] if s.name == target]
+        if not targets:
+            continue
+        target_txg = int(targets[0].createtxg)
+        pool = dataset.split(b"/", 1)[0]
+        pool_snapshots.setdefault(pool, []).append(target)
+        newer = sorted(
+            (
+                s for s in dataset_snapshots[dataset]
+                if int(s.createtxg) > target_txg
+            ),
+            key=lambda s: int(s.createtxg)
+        )
+        for snapshot in newer:
+            if snapshot.clones not in {b"", b"-"}:
+                blocked[snapshot.name] = snapshot.clones.split(b",")
+            else:
+                pool_newer.setdefault(pool, []).append(snapshot.name)
+    return RollbackPlan(pool_snapshots, pool_newer, blocked)
+
+
+def log_rollback_plan(plan):
+    for pool, targets in plan.pool_snapshots.items():
+        newer = plan.pool_newer.get(pool, [])
+        log.info(
+            "Pool '%s':\n\tRoll back to:%s\n\tDestroy first:%s",
+            pool.decode(default_encoding),
+            b"\n\t\t".join([b""] + targets).decode(default_encoding),
+            b"\n\t\t".join([b""] + newer).decode(default_encoding)
+            if newer else " (nothing)"
+        )
+    for snapshot, clones in plan.blocked.items():
+        log.error(
+            "Snapshot '%s' has clones that must be promoted or destroyed "
+            "first: %s",
+            snapshot.decode(default_encoding),
+            b", ".join(clones).decode(default_encoding)
+        )
+
+
+def execute_rollback(plan):
+    """Carry out a :py:class:`RollbackPlan`.
+
+    The newer snapshots in every pool are destroyed before any dataset is
+    rolled back, so the most likely failures happen before anything has been
+    rolled back. If an operation fails, the completed and remaining operations
+    are logged and the script exits.
+    """
+    operations = []
+    for pool, newer in plan.pool_newer.items():
+        operations.append((
+            "Destroy snapshots in pool '{}'".format(
+                pool.decode(default_encoding)
+            ),
+            functools.partial(destroy_snapshots, *newer)
+        ))
+    for targets in plan.pool_snapshots.values():
+        for target in targets:
+            operations.append((
+                "Roll back to '{}'".format(target.decode(default_encoding)),
+                functools.partial(rollback_snapshot, target)
+            ))
+    for index, (description, operation) in enumerate(operations):
+        log.info("%s", description)
+        try:
+            operation()
+        except APTSnapshotError as e:
+            completed = [d for d, _ in operations[:index]]
+            remaining = [d for d, _ in operations[index + 1:]]
+            log.error(
+                "ERROR: Rollback failed at: %s\n\t%s\n"
+                "Completed:%s\nNot run:%s",
+                description,
+                e,
+                "\n\t".join([""] + completed) if completed else " (nothing)",
+                "\n\t".join([""] + remaining) if remaining else " (nothing)"
+            )
+            sys.exit(1)
+
+
+def rollback(args):
+    """Plan a rollback, and carry it out if ``--execute`` was given."""
+    snapshot_name = args.rollback.lstrip("@")
+    if "@" in snapshot_name or not is_apt_snapshot(snapshot_name):
+        log.error(
+            "ERROR: '%s' is not the name of a snapshot made by this tool.",
+            args.rollback
+        )
+        sys.exit(1)
+    plan = plan_rollback(snapshot_name)
+    if not plan.pool_snapshots:
+        log.error("ERROR: No datasets have a snapshot '%s'.", snapshot_name)
+        sys.exit(1)
+    log_rollback_plan(plan)
+    if plan.blocked:
+        sys.exit(1)
+    if not args.execute:
+        log.info("Dry run, re-run with --execute to roll back.")
+        return
+    execute_rollback(plan)
+    # Forget about the rolled back datasets' snapshots so the coalescing
+    # window doesn't skip snapshotting them next time.
+    recent_snapshots = load_recent_snapshots(args.state_dir)
+    if recent_snapshots:
+        for targets in plan.pool_snapshots.values():
+            for target in targets:
+                recent_snapshots.pop(target.split(b"@", 1)[0], None)
+        save_recent_snapshots(args.state_dir, recent_snapshots)
+
+
 def get_config():
     parser = argparse.ArgumentParser(
         description=(
@@ -683,6 +1334,85 @@ def get_config():
         dest="list_old",
         help="List stale snapshots made by this tool."
     )
+    parser.add_argument(
+        "--defer-purge",
+        action="store_true",
+        dest="defer_purge",
+        help=(
+            "Only create snapshots, and record that stale snapshots should be "
+            "purged later by running this tool with --run-deferred-purge "
+            "(for example from the bundled systemd timer)."
+        )
+    )
+    parser.add_argument(
+        "--run-deferred-purge",
+        action="store_true",
+        dest="run_deferred_purge",
+        help=(
+            "Purge stale snapshots if a purge was recorded with "
+            "--defer-purge, then exit. No APT hook information is read in "
+            "this mode."
+        )
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store",
+        dest="rollback",
+        help=(
+            "Roll back every dataset with a snapshot of this name (made by "
+            "this tool) to that snapshot, destroying any newer snapshots of "
+            "those datasets. Only the planned operations are shown unless "
+            "--execute is also given. No APT hook information is read in "
+            "this mode."
+        ),
+        metavar="SNAPSHOT"
+    )
+    parser.add_argument(
+        "--execute",
+        action="store_true",
+        dest="execute",
+        help="Actually perform the rollback planned with --rollback."
+    )
+    parser.add_argument(
+        "--state-dir",
+        action="store",
+        default=str(STATE_DIRECTORY),
+        dest="state_dir",
+        help="Directory to keep state (like deferred purges) in.",
+        metavar="PATH",
+        type=pathlib.Path
+    )
+    parser.add_argument(
+        "--deferred-batch-size",
+        action="store",
+        default=50,
+        dest="deferred_batch_size",
+        help="Number of snapshots to destroy at once in a deferred purge.",
+        metavar="COUNT",
+        type=int
+    )
+    parser.add_argument(
+        "--deferred-interval",
+        action="store",
+        default=1.0,
+        dest="deferred_interval",
+        help="Seconds to wait between batches in a deferred purge.",
+        metavar="SECONDS",
+        type=float
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        action="store",
+        default=0,
+        dest="coalesce_window",
+        help=(
+            "Don't snapshot datasets that have been snapshotted by this tool "
+            "in the last this many minutes (for example by an earlier dpkg "
+            "run in the same upgrade). 0 disables this."
+        ),
+        metavar="MINUTES",
+        type=int
+    )
     parser.add_argument(
         "--old-period",
         action="store",
@@ -703,9 +1433,15 @@ def main(source):
     args = get_config()
     if args.verbose:
         log.level = logging.DEBUG
+    if args.run_deferred_purge:
+        run_deferred_purge(args)
+        return
+    if args.rollback is not None:
+        rollback(args)
+        return
     # Read the list of packages in
     paths = get_files(source)
-    filesystems = filesystems_for_files(paths)
+    filesystems = filesystems_for_files(paths, state_dir=args.state_dir)
 
     if args.respect_auto_snapshot:
         # Skip filesystems that have com.sun:auto-snapshot set to false
@@ -715,10 +1451,45 @@ def main(source):
             if properties.get("com.sun:auto-snapshot", True):
                 enabled_filesystems.add(fs)
     else:
-        enabled_filesystems = filesystems
+        enabled_filesystems = set(filesystems)
+
+    now = datetime.datetime.utcnow()
+    if args.coalesce_window > 0:
+        # Skip filesystems that were snapshotted recently enough that the
+        # existing snapshot still reflects the pre-upgrade state.
+        recent_snapshots = load_recent_snapshots(args.state_dir)
+        window_start = now - datetime.timedelta(minutes=args.coalesce_window)
+        recent_snapshots = {
+            fs: snapshot
+            for fs, snapshot in recent_snapshots.items()
+            if window_start <= snapshot.timestamp <= now
+        }
+        for fs in enabled_filesystems & recent_snapshots.keys():
+            recent = recent_snapshots[fs]
+            # Make sure the snapshot hasn't been destroyed since, otherwise
+            # the dataset would be left without a pre-upgrade snapshot. Only
+            # that one snapshot is looked up; listing it fails if it's gone.
+            try:
+                _zfs_list(recent.name, type_="snapshot")
+                exists = True
+            except ZFSListError:
+                exists = False
+            if not exists:
+                log.debug(
+                    "Recent snapshot '%s' no longer exists",
+                    recent.name.decode(default_encoding)
+                )
+                del recent_snapshots[fs]
+                continue
+            log.info(
+                "Skipping '%s', it was snapshotted at %s",
+                fs.decode(default_encoding),
+                recent.timestamp.strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+            )
+        enabled_filesystems = enabled_filesystems - recent_snapshots.keys()
 
     # Choose a name for the snapshot
-    timestamp = datetime.datetime.utcnow().strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+    timestamp = now.strftime(SNAPSHOT_TIMESTAMP_FORMAT)
     snapshot_name = "{}_{}".format(SNAPSHOT_PREFIX, timestamp)
     # This mess of decode()+encode() is because there isn't a format() method
     # for bytes.
@@ -733,8 +1504,25 @@ def main(source):
     for snapshot in filesystem_snapshots:
         log.info("Creating ZFS snapshot '%s'",
                  snapshot.decode(default_encoding))
-        create_snapshot(snapshot)
+        try:
+            create_snapshot(snapshot)
+        except SnapshotExists:
+            # Another run created this snapshot in the same second, so it
+            # already has the state we want.
+            log.info("Snapshot '%s' already exists",
+                     snapshot.decode(default_encoding))
+    if args.coalesce_window > 0:
+        recent_snapshots.update(
+            (snapshot.split(b"@", 1)[0], RecentSnapshot(snapshot, now))
+            for snapshot in filesystem_snapshots
+        )
+        save_recent_snapshots(args.state_dir, recent_snapshots)
     # Cleanup (if needed)
+    if args.defer_purge:
+        # Leave the listing and destroying to the background job, keeping it
+        # out of dpkg's way.
+        request_purge(args.state_dir, args.old_period)
+        return
     if args.list_old or args.purge:
         old_snaps = list_old(args.old_period)
     if args.list_old and old_snaps: